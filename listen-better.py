@@ -2,9 +2,17 @@
 # Make sure to install the Google AI SDK: pip install -q google-generativeai
 
 import os
-import json
+import hashlib
+import argparse
+import re
+import math
+import unicodedata
 import random
 import time
+import asyncio
+import aiohttp
+import numpy as np
+import orjson
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 import google.generativeai as genai # For Google AI API
@@ -25,11 +33,47 @@ ALL_RECS_PLAYLIST_NAME = "All AI Deep Cuts History"
 TARGET_NEW_SONGS_COUNT = 20
 MAX_GEMINI_ATTEMPTS = 10
 MAX_SONGS_TO_GEMINI_PROMPT = 150
+MAX_SONGS_PER_GEMINI_REQUEST = 50 # Gemini's JSON output degrades on larger batches
+MAX_PREVIOUS_SUGGESTIONS_IN_PROMPT = 40 # Older suggestions are still visible to Gemini in the chat history
+MIN_EXPECTED_KEEP_RATE = 0.1 # Floor for the observed share of suggestions that pass all filters
+
+# Spotify Web API settings used by the async (aiohttp) requests
+SPOTIFY_API_BASE_URL = "https://api.spotify.com"
+SPOTIFY_MAX_CONCURRENT_REQUESTS = 5
+SPOTIFY_REQUESTS_PER_SECOND = 10 # Stay under Spotify's rolling rate limit
+SPOTIFY_MAX_RETRIES = 5
+SPOTIFY_RETRY_STATUS_CODES = (500, 502, 503, 504) # Same transient errors spotipy retries
+SPOTIFY_BACKOFF_FACTOR = 0.3 # Waits 0.3s, 0.6s, 1.2s, ... between retries of transient errors
+SPOTIFY_TRACKS_BATCH_SIZE = 50 # Max IDs per /v1/tracks request
 
 # Model specified by user for Google AI API
 GEMINI_MODEL = "gemini-2.5-flash-preview-04-17"
 # If "gemini-2.5-flash-preview" doesn't work, try "gemini-1.5-flash-latest" or "gemini-1.5-pro-latest"
 
+# Configured once and shared by the chat session and the embedding requests
+genai.configure(api_key=GOOGLE_AI_API_KEY)
+_GEMINI_MODEL = genai.GenerativeModel(GEMINI_MODEL)
+GEMINI_TEMPERATURE = 0.7
+
+# Structured-output schema: Gemini must answer with a JSON array of {"track", "artist"} objects
+RECS_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "track": {"type": "STRING"},
+            "artist": {"type": "STRING"},
+        },
+        "required": ["track", "artist"],
+    },
+}
+
+# Gemini response cache. Responses are non-deterministic (temperature > 0), so this is only
+# meant for development runs: set GEMINI_CACHE=1 in .env to replay identical requests for free.
+GEMINI_CACHE_ENABLED = os.getenv("GEMINI_CACHE") == "1"
+GEMINI_CACHE_PATH = ".gemini_cache.json"
+GEMINI_CACHE_SHUFFLE_SEED = 42 # Keeps the liked-songs sample (and so the prompts) stable while caching
+
 # --- New Configuration for Recommendation Quality ---
 MAX_POPULARITY_THRESHOLD = 60
 MIN_RELEASE_YEAR = 2021
@@ -49,6 +93,32 @@ DISFAVORED_ELEMENTS_HINT = (
     "overly sentimental ballads, or background music. I want to be actively engaged by the music."
 )
 
+# Follow-up prompt for every Gemini attempt after the first. The static preferences are filled in
+# here once; songs_to_request and previous_suggestions are filled in per attempt with .format().
+FOLLOW_UP_PROMPT_TEMPLATE = f"""Thank you. Now, please provide {{songs_to_request}} MORE unique song recommendations.
+It's crucial that these new recommendations are different from any songs you've already suggested to me in this conversation. For reference, here are the songs you've suggested so far (please avoid these entirely):
+{{previous_suggestions}}
+
+Also, ensure these new recommendations are different from the initial list of liked songs I provided (at the very start of our conversation).
+Remember my core preferences for music that is challenging, thoughtful, inspiring, and NEW (ideally released {MIN_RELEASE_YEAR or 'any year'} or later, by lesser-known or emerging artists, and not overly popular - e.g. Spotify popularity < {MAX_POPULARITY_THRESHOLD or 'any score'}).
+My style preferences: {FAVORED_STYLES_HINT}
+Elements to avoid: {DISFAVORED_ELEMENTS_HINT}
+Ensure artist variety in this new batch.
+
+Your response must be ONLY a valid JSON array of objects, with "track" and "artist" keys, as before."""
+
+# Semantic de-duplication: catches re-suggestions that differ only in spelling or punctuation
+# (e.g. "Björk - Hidden Place" vs "Bjork – Hidden Place"). Set the threshold to None to disable.
+EMBEDDING_MODEL = "models/text-embedding-004"
+EMBEDDING_DIM = 768
+EMBEDDING_BATCH_SIZE = 100 # Max contents per embed_content call
+SEMANTIC_DUPLICATE_THRESHOLD = 0.92 # Cosine similarity above which two songs count as the same
+EMBEDDINGS_CACHE_PATH = ".embeddings_cache.npz" # Per-song embeddings, reused across runs
+
+# Gemini suggestions rejected in earlier runs (not found, too popular, too old, in history), per user.
+# Delete this file after changing MAX_POPULARITY_THRESHOLD or MIN_RELEASE_YEAR.
+REJECTED_CACHE_PATH = ".rejected_cache.json"
+
 # --- Helper Functions ---
 
 def get_spotify_client():
@@ -59,51 +129,210 @@ def get_spotify_client():
         scope=SCOPES,
         cache_path=".spotify_cache_token_info" # More specific cache file name
     )
-    sp = spotipy.Spotify(auth_manager=auth_manager)
+    # spotipy retries HTTP 429 itself, waiting for Spotify's Retry-After, so no fixed sleeps are needed
+    sp = RateLimitedSpotify(auth_manager=auth_manager, retries=SPOTIFY_MAX_RETRIES, status_retries=SPOTIFY_MAX_RETRIES)
     print("Successfully authenticated with Spotify.")
     return sp
 
+_NON_WORD_RE = re.compile(r'[\W_]+')
+
+def normalize_song_text(text):
+    """
+    Case- and accent-insensitive form of a track/artist name with punctuation stripped.
+    casefold() also handles non-ASCII names (e.g. Björk) more correctly than lower().
+    """
+    return _NON_WORD_RE.sub('', unicodedata.normalize('NFKD', text).casefold())
+
+def normalized_song_key(song_detail):
+    if '_norm_track' in song_detail:
+        return (song_detail['_norm_track'], song_detail['_norm_artist'])
+    return (normalize_song_text(song_detail['track']), normalize_song_text(song_detail['artist']))
+
+def song_key(track_name, artist_name):
+    return f"{track_name}\0{artist_name}"
+
+def fingerprint_u64(text):
+    """64-bit BLAKE2b fingerprint of a string (e.g. a song key or Spotify track ID)."""
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+
+def fingerprints_of(texts):
+    return np.fromiter((fingerprint_u64(t) for t in texts), dtype=np.uint64)
+
+def build_fingerprint_index(texts):
+    """Returns the sorted, unique uint64 fingerprints of `texts` (8 bytes per entry)."""
+    return np.unique(fingerprints_of(texts))
+
+def contains_fingerprints(sorted_fingerprints, fingerprints):
+    """Vectorised membership test: binary-searches each fingerprint in a sorted index."""
+    if len(sorted_fingerprints) == 0:
+        return np.zeros(len(fingerprints), dtype=bool)
+    positions = np.searchsorted(sorted_fingerprints, fingerprints)
+    positions = np.minimum(positions, len(sorted_fingerprints) - 1)
+    return sorted_fingerprints[positions] == fingerprints
+
+class LeakyBucket:
+    """
+    Rate limiter letting requests leak out at `rate_per_sec`, with bursts of up to `capacity`.
+    State is kept as timestamps rather than asyncio primitives, so one instance can be shared by
+    synchronous calls (acquire_sync) and by async calls across separate asyncio.run() loops.
+    """
+    def __init__(self, rate_per_sec, capacity=None):
+        self.interval = 1 / rate_per_sec
+        self._burst_allowance = ((capacity or max(1, int(rate_per_sec))) - 1) * self.interval
+        self._next_slot_at = 0.0 # When the bucket will have fully drained
+        self._resume_at = 0.0
+
+    def _reserve(self):
+        """Claims the next request slot and returns how many seconds to wait for it."""
+        now = time.monotonic()
+        self._next_slot_at = max(self._next_slot_at, now, self._resume_at) + self.interval
+        return max(0.0, max(self._next_slot_at - self.interval - self._burst_allowance, self._resume_at) - now)
+
+    def pause(self, seconds):
+        """Holds back every caller for `seconds`, e.g. after Spotify answers 429 with Retry-After."""
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    async def acquire(self):
+        await asyncio.sleep(self._reserve())
+
+    def acquire_sync(self):
+        time.sleep(self._reserve())
+
+
+# One limiter for every Spotify request in the run, from spotipy and aiohttp alike
+_SPOTIFY_RATE_LIMITER = LeakyBucket(SPOTIFY_REQUESTS_PER_SECOND)
+
+class RateLimitedSpotify(spotipy.Spotify):
+    """spotipy client whose requests all go through the shared Spotify rate limiter."""
+    def _internal_call(self, method, url, payload, params):
+        _SPOTIFY_RATE_LIMITER.acquire_sync()
+        return super()._internal_call(method, url, payload, params)
+
+def get_spotify_access_token(sp):
+    return sp.auth_manager.get_access_token(as_dict=False)
+
+class SpotifyAsyncSession:
+    """
+    aiohttp session for the Spotify Web API. Requests are bounded by a concurrency semaphore and
+    go through the run-wide _SPOTIFY_RATE_LIMITER. When Spotify answers HTTP 429, the shared
+    limiter pauses every caller for the Retry-After delay before the request is retried.
+    Use as `async with SpotifyAsyncSession(sp) as spotify:`.
+    """
+    def __init__(self, sp):
+        self._headers = {"Authorization": f"Bearer {get_spotify_access_token(sp)}"}
+        self._session = None
+        self._sem = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(base_url=SPOTIFY_API_BASE_URL, headers=self._headers)
+        self._sem = asyncio.Semaphore(SPOTIFY_MAX_CONCURRENT_REQUESTS)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._session.close()
+
+    async def get_json(self, path, params=None):
+        """
+        GETs a Spotify Web API path. HTTP 429 is retried after Retry-After; transient server
+        and connection errors are retried with exponential backoff, like spotipy does.
+        """
+        for attempt in range(SPOTIFY_MAX_RETRIES):
+            try:
+                async with self._sem:
+                    await _SPOTIFY_RATE_LIMITER.acquire()
+                    async with self._session.get(path, params=params) as response:
+                        if response.status == 429:
+                            retry_after = int(response.headers.get("Retry-After", "1"))
+                        elif response.status in SPOTIFY_RETRY_STATUS_CODES:
+                            retry_after = None
+                            error = f"HTTP {response.status}"
+                        else:
+                            response.raise_for_status()
+                            return orjson.loads(await response.read())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                retry_after = None
+                error = repr(e)
+            if retry_after is not None:
+                print(f"  Spotify rate limit hit, retrying {path} in {retry_after}s...")
+                _SPOTIFY_RATE_LIMITER.pause(retry_after)
+            else:
+                backoff = SPOTIFY_BACKOFF_FACTOR * 2 ** attempt
+                print(f"  Spotify request {path} failed ({error}), retrying in {backoff:.1f}s...")
+                await asyncio.sleep(backoff)
+        raise RuntimeError(f"Spotify request {path} still failing after {SPOTIFY_MAX_RETRIES} attempts.")
+
+async def fetch_spotify_pages_async(sp, path, offsets, limit, params=None):
+    """
+    Fetches the pages of a paginated Spotify endpoint at the given offsets concurrently.
+    Returns the pages in offset order. Raises if any page still fails after retries, so
+    callers never carry on with a silently incomplete list.
+    """
+    if not offsets:
+        return []
+    async with SpotifyAsyncSession(sp) as spotify:
+        return await asyncio.gather(*[
+            spotify.get_json(path, params={**(params or {}), "limit": limit, "offset": offset})
+            for offset in offsets
+        ])
+
 def get_all_liked_songs_details(sp):
+    """Returns all liked songs, or None if any page couldn't be fetched."""
     print("Fetching all liked songs details...")
     liked_songs_details = []
-    offset = 0
     limit = 50
-    while True:
-        try:
-            results = sp.current_user_saved_tracks(limit=limit, offset=offset)
-            if not results or not results['items']:
-                break
-            for item in results['items']:
-                track = item.get('track')
-                if track and track.get('name') and track.get('artists'):
-                    if track['artists']:
-                        artist_name = track['artists'][0]['name']
-                        liked_songs_details.append({
-                            "track": track['name'],
-                            "artist": artist_name,
-                        })
-            offset += limit
-            print(f"Fetched {len(liked_songs_details)} liked songs so far...")
-            if not results.get('next'):
-                break
-            time.sleep(0.05)
-        except Exception as e:
-            print(f"Error fetching liked songs page: {e}")
-            break
+    try:
+        first_page = sp.current_user_saved_tracks(limit=limit, offset=0)
+        if not first_page or not first_page['items']:
+            print(f"Total liked songs details fetched: {len(liked_songs_details)}")
+            return liked_songs_details
+
+        offsets = range(limit, first_page.get('total', 0), limit)
+        if offsets:
+            print(f"Fetching {len(offsets)} more pages of liked songs in parallel...")
+        pages = [first_page] + asyncio.run(fetch_spotify_pages_async(sp, "/v1/me/tracks", offsets, limit))
+    except Exception as e:
+        print(f"Error fetching liked songs: {e}")
+        return None
+    for results in pages:
+        for item in results['items']:
+            track = item.get('track')
+            if track and track.get('name') and track.get('artists'):
+                if track['artists']:
+                    artist_name = track['artists'][0]['name']
+                    liked_songs_details.append({
+                        "track": track['name'],
+                        "artist": artist_name,
+                        "_norm_track": normalize_song_text(track['name']),
+                        "_norm_artist": normalize_song_text(artist_name),
+                    })
     print(f"Total liked songs details fetched: {len(liked_songs_details)}")
     return liked_songs_details
 
+_PLAYLIST_CACHE = {} # user_id -> all of that user's playlists, fetched once per run
+
+def list_all_user_playlists(sp, user_id):
+    """
+    Returns every playlist of the current user. Pages after the first are fetched in parallel,
+    and the result is memoized so repeated lookups within a run don't hit Spotify again.
+    Raises if the list couldn't be fetched completely (a missing page could hide a playlist).
+    """
+    if user_id in _PLAYLIST_CACHE:
+        return _PLAYLIST_CACHE[user_id]
+    limit = 50
+    first_page = sp.current_user_playlists(limit=limit)
+    playlists = []
+    if first_page:
+        offsets = range(limit, first_page.get('total', 0), limit)
+        pages = [first_page] + asyncio.run(fetch_spotify_pages_async(sp, "/v1/me/playlists", offsets, limit))
+        for page in pages:
+            playlists.extend(playlist for playlist in page['items'] if playlist)
+    _PLAYLIST_CACHE[user_id] = playlists
+    return playlists
+
 def get_playlist_by_name(sp, playlist_name, user_id):
-    playlists = sp.current_user_playlists(limit=50)
-    while playlists:
-        for playlist in playlists['items']:
-            if playlist['name'] == playlist_name and playlist['owner']['id'] == user_id:
-                return playlist
-        if playlists['next']:
-            playlists = sp.next(playlists)
-            time.sleep(0.05)
-        else:
-            playlists = None
+    for playlist in list_all_user_playlists(sp, user_id):
+        if playlist['name'] == playlist_name and playlist['owner']['id'] == user_id:
+            return playlist
     return None
 
 def get_or_create_playlist_id(sp, user_id, playlist_name, public=True):
@@ -116,113 +345,164 @@ def get_or_create_playlist_id(sp, user_id, playlist_name, public=True):
         try:
             new_playlist = sp.user_playlist_create(user=user_id, name=playlist_name, public=public)
             print(f"Successfully created playlist: '{playlist_name}' (ID: {new_playlist['id']})")
+            if user_id in _PLAYLIST_CACHE:
+                _PLAYLIST_CACHE[user_id].append(new_playlist)
             return new_playlist['id']
         except Exception as e:
             print(f"Error creating playlist '{playlist_name}': {e}")
             return None
 
 def get_playlist_tracks_simplified(sp, playlist_id):
+    """Returns all tracks of a playlist, or None if any page couldn't be fetched."""
     if not playlist_id: return []
     print(f"Fetching tracks from playlist ID: {playlist_id}...")
     playlist_tracks = []
-    offset = 0
     limit = 100
-    while True:
-        try:
-            results = sp.playlist_items(playlist_id, limit=limit, offset=offset,
-                                        fields="items(track(id,name,artists(name))),next")
-            if not results or not results['items']: break
-            for item in results['items']:
-                track_info = item.get('track')
-                if track_info and track_info.get('id') and track_info.get('name') and track_info.get('artists'):
-                    if track_info['artists']:
-                        artist_name = track_info['artists'][0]['name']
-                        playlist_tracks.append({
-                            "track": track_info['name'],
-                            "artist": artist_name,
-                            "id": track_info['id']
-                        })
-            offset += limit
-            print(f"Fetched {len(playlist_tracks)} tracks from playlist ID {playlist_id} so far...")
-            if not results.get('next'): break
-            time.sleep(0.05)
-        except Exception as e:
-            print(f"Error fetching playlist items for {playlist_id}: {e}")
-            break
+    fields = "items(track(id,name,artists(name))),next,total"
+    try:
+        first_page = sp.playlist_items(playlist_id, limit=limit, offset=0, fields=fields)
+        if not first_page or not first_page['items']:
+            print(f"Total tracks fetched from playlist ID {playlist_id}: {len(playlist_tracks)}")
+            return playlist_tracks
+
+        offsets = range(limit, first_page.get('total', 0), limit)
+        if offsets:
+            print(f"Fetching {len(offsets)} more pages from playlist ID {playlist_id} in parallel...")
+        pages = [first_page] + asyncio.run(
+            fetch_spotify_pages_async(sp, f"/v1/playlists/{playlist_id}/tracks", offsets, limit, params={"fields": fields})
+        )
+    except Exception as e:
+        print(f"Error fetching playlist items for {playlist_id}: {e}")
+        return None
+    for results in pages:
+        for item in results['items']:
+            track_info = item.get('track')
+            if track_info and track_info.get('id') and track_info.get('name') and track_info.get('artists'):
+                if track_info['artists']:
+                    artist_name = track_info['artists'][0]['name']
+                    playlist_tracks.append({
+                        "track": track_info['name'],
+                        "artist": artist_name,
+                        "id": track_info['id']
+                    })
     print(f"Total tracks fetched from playlist ID {playlist_id}: {len(playlist_tracks)}")
     return playlist_tracks
 
-def get_gemini_recommendations_google_ai(api_key, conversation_history_raw, model_name_to_use):
+def load_rejected_songs(user_id):
+    if not os.path.exists(REJECTED_CACHE_PATH):
+        return set()
+    try:
+        with open(REJECTED_CACHE_PATH, "rb") as f:
+            rejected = {tuple(key) for key in orjson.loads(f.read()).get(user_id, [])}
+        print(f"Loaded {len(rejected)} previously rejected suggestions from {REJECTED_CACHE_PATH}.")
+        return rejected
+    except (OSError, orjson.JSONDecodeError) as e:
+        print(f"Warning: Could not read {REJECTED_CACHE_PATH}: {e}")
+        return set()
+
+def save_rejected_songs(user_id, rejected_songs_keys):
+    all_users_rejected = {}
+    try:
+        if os.path.exists(REJECTED_CACHE_PATH):
+            with open(REJECTED_CACHE_PATH, "rb") as f:
+                all_users_rejected = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError) as e:
+        print(f"Warning: Could not read {REJECTED_CACHE_PATH}, overwriting it: {e}")
+    all_users_rejected[user_id] = sorted(list(key) for key in rejected_songs_keys)
+    try:
+        with open(REJECTED_CACHE_PATH, "wb") as f:
+            f.write(orjson.dumps(all_users_rejected))
+    except OSError as e:
+        print(f"Warning: Could not write {REJECTED_CACHE_PATH}: {e}")
+
+class GeminiCache:
     """
-    Sends the conversation history to Google AI Gemini and requests recommendations.
-    Returns a tuple: (parsed_recommendations_list, raw_assistant_response_content_string)
+    Exact-match cache of Gemini responses, persisted as a single JSON file.
+    Keys are the SHA-256 of the model name, conversation history and temperature.
     """
-    print(f"\nSending request to Google AI ({model_name_to_use}) with {len(conversation_history_raw)} messages in history...")
-
-    if not api_key:
-        print("Error: Google AI API Key is not provided.")
-        return [], None
-
-    genai.configure(api_key=api_key)
-
-    adapted_history = []
-    for msg in conversation_history_raw:
-        role = "model" if msg["role"] == "assistant" else msg["role"]
-        adapted_history.append({'role': role, 'parts': [msg['content']]})
+    def __init__(self, path=GEMINI_CACHE_PATH):
+        self.path = path
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    self._entries = orjson.loads(f.read())
+                print(f"Loaded {len(self._entries)} cached Gemini responses from {path}.")
+            except (OSError, orjson.JSONDecodeError) as e:
+                print(f"Warning: Could not read Gemini cache {path}, starting with an empty cache: {e}")
+
+    @staticmethod
+    def make_key(model_name, history, temperature):
+        payload = orjson.dumps({"model": model_name, "history": history, "temperature": temperature},
+                               option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(payload).hexdigest()
+
+    def get(self, key):
+        """Returns the cached (recommendations, raw_response) tuple, or None on a miss."""
+        entry = self._entries.get(key)
+        return (entry["recommendations"], entry["raw_response"]) if entry else None
+
+    def set(self, key, value):
+        recommendations, raw_response = value
+        self._entries[key] = {"recommendations": recommendations, "raw_response": raw_response}
+        try:
+            with open(self.path, "wb") as f:
+                f.write(orjson.dumps(self._entries))
+        except OSError as e:
+            print(f"Warning: Could not write Gemini cache {self.path}: {e}")
 
-    if not adapted_history or adapted_history[-1]["role"] != "user":
-        print("Error: Conversation history is empty or does not end with a user role message after adaptation.")
-        return [], None
+def get_gemini_recommendations_google_ai(chat, user_prompt_content, cache=None):
+    """
+    Sends the next user turn to a Google AI Gemini chat session and requests recommendations.
+    The session tracks the conversation client-side (replacing hand-built history bookkeeping);
+    the full history is still sent to the API with every turn.
+    If a GeminiCache is given, an identical earlier request is answered from it instead.
+    Returns a tuple: (parsed_recommendations_list, raw_assistant_response_content_string)
+    """
+    model_name_to_use = chat.model.model_name
+    print(f"\nSending request to Google AI ({model_name_to_use}) with {len(chat.history)} messages in history...")
+
+    cache_key = None
+    if cache is not None:
+        history = [{'role': content.role, 'parts': [part.text for part in content.parts]} for content in chat.history]
+        history.append({'role': 'user', 'parts': [user_prompt_content]})
+        cache_key = GeminiCache.make_key(model_name_to_use, history, GEMINI_TEMPERATURE)
+        cached = cache.get(cache_key)
+        if cached:
+            print(f"Using cached Google AI response ({len(cached[0])} recommendations).")
+            # Replay the turn into the chat so follow-up requests see it
+            chat.history = [*chat.history,
+                            {'role': 'user', 'parts': [user_prompt_content]},
+                            {'role': 'model', 'parts': [cached[1]]}]
+            return cached
 
     try:
-        # Initialize the model. You can set a default temperature here if you want,
-        # but response_mime_type is best set per generate_content call for clarity and reliability.
-        model = genai.GenerativeModel(
-            model_name_to_use
-            # You could still set a default temperature for the model instance if desired:
-            # generation_config=genai.types.GenerationConfig(temperature=0.7)
-        )
-
-        # The entire adapted history is passed. The API handles the turns.
-        # Pass the GenerationConfig with response_mime_type HERE:
-        response = model.generate_content(
-            adapted_history,
+        # Pass the GenerationConfig with response_mime_type and response_schema HERE:
+        response = chat.send_message(
+            user_prompt_content,
             generation_config=genai.types.GenerationConfig(
-                temperature=0.7, # You can also set temperature here
-                response_mime_type="application/json" # Crucial for JSON output
+                temperature=GEMINI_TEMPERATURE, # You can also set temperature here
+                response_mime_type="application/json", # Crucial for JSON output
+                response_schema=RECS_SCHEMA # Constrains the output to our list-of-songs shape
             ),
             request_options={"timeout": 120} # Increased timeout
         )
 
         raw_assistant_response_content = response.text
 
-        recommendations = []
+        # response_schema guarantees a list of {"track": str, "artist": str} objects
         try:
-            parsed_content = json.loads(raw_assistant_response_content)
-            if isinstance(parsed_content, list):
-                recommendations = parsed_content
-            elif isinstance(parsed_content, dict) and len(parsed_content.keys()) == 1:
-                key = list(parsed_content.keys())[0]
-                if isinstance(parsed_content[key], list):
-                    recommendations = parsed_content[key]
-                else:
-                    print(f"Google AI returned a dictionary but the value under key '{key}' was not a list.")
-            else:
-                 print("Google AI response was JSON, but not in the expected list or single-key-list format.")
-
-        except json.JSONDecodeError as e_json:
+            recommendations = orjson.loads(raw_assistant_response_content)
+        except orjson.JSONDecodeError as e_json:
             print(f"Error: Google AI response could not be parsed as JSON: {e_json}")
             print(f"Google AI Raw Response Content:\n{raw_assistant_response_content}")
             return [], raw_assistant_response_content
 
-        valid_recommendations = []
-        for rec in recommendations:
-            if isinstance(rec, dict) and "track" in rec and "artist" in rec:
-                valid_recommendations.append({"track": str(rec["track"]), "artist": str(rec["artist"])})
-            else:
-                print(f"Warning: Skipping invalid recommendation format from Google AI: {rec}")
+        valid_recommendations = [{"track": rec["track"], "artist": rec["artist"]} for rec in recommendations]
 
         print(f"Received {len(valid_recommendations)} validly structured recommendations from Google AI.")
+        if cache_key and valid_recommendations:
+            cache.set(cache_key, (valid_recommendations, raw_assistant_response_content))
         return valid_recommendations, raw_assistant_response_content
 
     except Exception as e:
@@ -232,52 +512,207 @@ def get_gemini_recommendations_google_ai(api_key, conversation_history_raw, mode
         return [], None
 
 
-def verify_and_filter_songs_on_spotify(sp, recommended_songs_details):
+def parse_release_year(release_date_str, track_name):
+    if not release_date_str:
+        return None
+    try:
+        return int(release_date_str.split('-')[0])
+    except ValueError:
+        if len(release_date_str) == 4 and release_date_str.isdigit():
+            return int(release_date_str)
+        print(f"  Warning: Could not parse year from release_date: {release_date_str} for track {track_name}")
+        return None
+
+def song_info_from_track(found_track):
+    return {
+        "uri": found_track['uri'],
+        "id": found_track['id'],
+        "track": found_track['name'],
+        "artist": found_track['artists'][0]['name'],
+        "popularity": found_track.get('popularity'),
+        "release_year": parse_release_year(found_track.get('album', {}).get('release_date'), found_track['name']),
+        "_norm_track": normalize_song_text(found_track['name']),
+        "_norm_artist": normalize_song_text(found_track['artists'][0]['name'])
+    }
+
+async def _search_one(spotify, track_name, artist_name):
+    """
+    Returns the Spotify ID of the best match for a Gemini suggestion, or None.
+    Only the ID is read here; popularity and release date come from the batched /v1/tracks call.
+    """
+    query = f"track:{track_name} artist:{artist_name}"
+    results = await spotify.get_json("/v1/search",
+                                     params={"q": query, "type": "track", "limit": 1, "market": "from_token"})
+    if results and results['tracks']['items']:
+        return results['tracks']['items'][0]['id']
+    return None
+
+async def _fetch_tracks_batch(spotify, track_ids):
+    """Fetches up to SPOTIFY_TRACKS_BATCH_SIZE full track objects in a single /v1/tracks call."""
+    try:
+        results = await spotify.get_json("/v1/tracks", params={"ids": ",".join(track_ids)})
+        return [track for track in results.get('tracks', []) if track]
+    except Exception as e:
+        print(f"  Error fetching details for {len(track_ids)} tracks from Spotify: {e}")
+        return []
+
+async def verify_and_filter_songs_on_spotify_async(sp, recommended_songs_details):
+    """
+    Looks up every Gemini suggestion on Spotify concurrently (through a rate-limited
+    SpotifyAsyncSession), then fetches popularity and release dates for all matches
+    with batched /v1/tracks calls.
+    Returns a tuple: (enriched_song_info_list, not_found_songs_details). Each enriched song info
+    keeps the Gemini suggestion it was found for under "suggestion".
+    """
     print("\nVerifying Gemini recommendations on Spotify and applying filters...")
-    enriched_songs_info = []
+    songs_to_search = []
     for song_detail in recommended_songs_details:
         track_name = song_detail.get('track')
         artist_name = song_detail.get('artist')
         if not track_name or not artist_name:
             print(f"  Skipping malformed Gemini suggestion: {song_detail}")
             continue
+        songs_to_search.append(song_detail)
+
+    async with SpotifyAsyncSession(sp) as spotify:
+        search_results = await asyncio.gather(
+            *[_search_one(spotify, s['track'], s['artist']) for s in songs_to_search],
+            return_exceptions=True
+        )
+        found_track_ids = []
+        not_found_songs_details = []
+        for song_detail, result in zip(songs_to_search, search_results):
+            if isinstance(result, Exception):
+                print(f"  Error searching Spotify for '{song_detail['track']}' by '{song_detail['artist']}': {result}")
+                result = None
+            elif result is None:
+                print(f"  Spotify Lookup: Gemini suggestion '{song_detail['track']}' by '{song_detail['artist']}' not found on Spotify.")
+                not_found_songs_details.append(song_detail)
+            found_track_ids.append(result)
+        unique_track_ids = list(dict.fromkeys(track_id for track_id in found_track_ids if track_id))
+        track_batches = await asyncio.gather(*[
+            _fetch_tracks_batch(spotify, unique_track_ids[i:i + SPOTIFY_TRACKS_BATCH_SIZE])
+            for i in range(0, len(unique_track_ids), SPOTIFY_TRACKS_BATCH_SIZE)
+        ])
+    tracks_by_id = {track['id']: track for batch in track_batches for track in batch}
+    enriched_songs_info = [{**song_info_from_track(tracks_by_id[track_id]), "suggestion": song_detail}
+                           for song_detail, track_id in zip(songs_to_search, found_track_ids)
+                           if track_id in tracks_by_id]
 
-        query = f"track:{track_name} artist:{artist_name}"
-        try:
-            results = sp.search(q=query, type="track", limit=1)
-            time.sleep(0.05)
-            if results and results['tracks']['items']:
-                found_track = results['tracks']['items'][0]
-                
-                release_date_str = found_track.get('album', {}).get('release_date')
-                release_year = None
-                if release_date_str:
-                    try:
-                        release_year = int(release_date_str.split('-')[0])
-                    except ValueError:
-                        if len(release_date_str) == 4 and release_date_str.isdigit():
-                            release_year = int(release_date_str)
-                        else:
-                            print(f"  Warning: Could not parse year from release_date: {release_date_str} for track {found_track['name']}")
-                
-                song_info = {
-                    "uri": found_track['uri'],
-                    "id": found_track['id'],
-                    "track": found_track['name'],
-                    "artist": found_track['artists'][0]['name'],
-                    "popularity": found_track.get('popularity'),
-                    "release_year": release_year
-                }
-                enriched_songs_info.append(song_info)
-            else:
-                print(f"  Spotify Lookup: Gemini suggestion '{track_name}' by '{artist_name}' not found on Spotify.")
-        except Exception as e:
-            print(f"  Error searching Spotify for '{track_name}' by '{artist_name}': {e}")
-    
     print(f"Found {len(enriched_songs_info)} Gemini suggestions on Spotify. Now applying custom filters...")
-    return enriched_songs_info
+    return enriched_songs_info, not_found_songs_details
 
 
+def embed_songs(songs_details):
+    """
+    Embeds "track — artist" strings with the Google AI embedding model.
+    Returns a float32 array of shape (len(songs_details), EMBEDDING_DIM) with unit-length rows,
+    so a dot product between rows is their cosine similarity.
+    """
+    if not songs_details:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    vectors = []
+    for i in range(0, len(songs_details), EMBEDDING_BATCH_SIZE):
+        batch = songs_details[i:i + EMBEDDING_BATCH_SIZE]
+        result = genai.embed_content(
+            model=EMBEDDING_MODEL,
+            content=[f"{s['track']} — {s['artist']}" for s in batch],
+            task_type="semantic_similarity"
+        )
+        vectors.extend(result['embedding'])
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+class EmbeddingCache:
+    """
+    On-disk memo of song embeddings, keyed by the 64-bit fingerprint of the normalized
+    "track\0artist". Re-runs only embed songs that haven't been seen before. The file records
+    EMBEDDING_MODEL and EMBEDDING_DIM and is discarded when either has changed.
+    """
+    def __init__(self, path=EMBEDDINGS_CACHE_PATH):
+        self.path = path
+        self._vectors = {}
+        self._dirty = False
+        if os.path.exists(path):
+            try:
+                with np.load(path) as cached:
+                    if ('model' in cached.files and str(cached['model']) == EMBEDDING_MODEL
+                            and int(cached['dim']) == EMBEDDING_DIM):
+                        self._vectors = dict(zip(cached['hashes'].tolist(), cached['vecs']))
+                        print(f"Loaded {len(self._vectors)} cached song embeddings from {path}.")
+                    else:
+                        print(f"Ignoring {path}: it was built for a different embedding model.")
+                        self._dirty = True # Overwrite it on the next save
+            except Exception as e:
+                print(f"Warning: Could not read {path}, starting with an empty cache: {e}")
+
+    def embed(self, songs_details):
+        """Same as embed_songs, but only calls the API for songs missing from the cache."""
+        keys = [fingerprint_u64(song_key(*normalized_song_key(s))) for s in songs_details]
+        misses = {}
+        for key, song_detail in zip(keys, songs_details):
+            if key not in self._vectors:
+                misses.setdefault(key, song_detail)
+        if misses:
+            print(f"Embedding {len(misses)} songs not found in the embeddings cache...")
+            self._vectors.update(zip(misses.keys(), embed_songs(list(misses.values()))))
+            self._dirty = True
+        if not keys:
+            return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        return np.vstack([self._vectors[key] for key in keys])
+
+    def save(self):
+        if not self._dirty or not self._vectors:
+            return
+        try:
+            np.savez_compressed(self.path,
+                                model=np.array(EMBEDDING_MODEL),
+                                dim=np.array(EMBEDDING_DIM),
+                                hashes=np.array(list(self._vectors.keys()), dtype=np.uint64),
+                                vecs=np.vstack(list(self._vectors.values())).astype(np.float32))
+            self._dirty = False
+        except OSError as e:
+            print(f"Warning: Could not write {self.path}: {e}")
+
+def is_semantic_duplicate(vector, embeddings):
+    return len(embeddings) > 0 and float(np.max(embeddings @ vector)) > SEMANTIC_DUPLICATE_THRESHOLD
+
+def drop_semantic_duplicates(recommended_songs_details, suggestion_embeddings, liked_song_embeddings, embedding_cache):
+    """
+    Drops Gemini suggestions that are near-duplicates of a liked song or of an earlier suggestion.
+    Returns (kept_songs_details, suggestion_embeddings with the kept songs appended).
+    """
+    try:
+        new_vectors = embedding_cache.embed(recommended_songs_details)
+    except Exception as e:
+        print(f"Warning: Could not embed Gemini suggestions, skipping semantic de-duplication: {e}")
+        return recommended_songs_details, suggestion_embeddings
+
+    kept_songs_details = []
+    for song_detail, vector in zip(recommended_songs_details, new_vectors):
+        if is_semantic_duplicate(vector, liked_song_embeddings):
+            print(f"  -- DUPLICATE: '{song_detail['track']}' by {song_detail['artist']} matches a liked song.")
+        elif is_semantic_duplicate(vector, suggestion_embeddings):
+            print(f"  -- DUPLICATE: '{song_detail['track']}' by {song_detail['artist']} was already suggested.")
+        else:
+            kept_songs_details.append(song_detail)
+            suggestion_embeddings = np.vstack([suggestion_embeddings, vector])
+    return kept_songs_details, suggestion_embeddings
+
+
+def get_playlist_track_uris(sp, playlist_id):
+    """Returns the track URIs of a playlist in order, or None if they couldn't be fetched."""
+    try:
+        track_uris = []
+        results = sp.playlist_items(playlist_id, fields="items(track(uri)),next")
+        while results:
+            track_uris.extend((item.get('track') or {}).get('uri') for item in results['items'])
+            results = sp.next(results) if results.get('next') else None
+        return track_uris
+    except Exception as e:
+        print(f"Error fetching current items of playlist {playlist_id}: {e}")
+        return None
+
 def update_playlist_items(sp, playlist_id, track_uris, replace=False):
     if not playlist_id: return False
     if not track_uris and not replace: return True
@@ -288,29 +723,42 @@ def update_playlist_items(sp, playlist_id, track_uris, replace=False):
             return True
         except Exception as e: print(f"Error clearing playlist {playlist_id}: {e}"); return False
 
+    if replace:
+        current_uris = get_playlist_track_uris(sp, playlist_id)
+        if current_uris == track_uris:
+            print("No changes; playlist already up to date.")
+            return True
+        if current_uris is not None and current_uris == track_uris[:len(current_uris)]:
+            # Playlist already holds the start of the new list: append just the rest
+            print(f"Playlist ID {playlist_id} already has the first {len(current_uris)} songs.")
+            return update_playlist_items(sp, playlist_id, track_uris[len(current_uris):], replace=False)
+
     action = "Replacing items in" if replace else "Adding items to"
     print(f"{action} playlist ID {playlist_id} with {len(track_uris)} songs...")
     try:
         if replace:
-            if len(track_uris) <= 100:
-                 sp.playlist_replace_items(playlist_id, track_uris)
-            else:
-                sp.playlist_replace_items(playlist_id, [])
-                for i in range(0, len(track_uris), 100):
-                    sp.playlist_add_items(playlist_id, track_uris[i:i + 100])
-                    if i + 100 < len(track_uris): time.sleep(0.2)
+            # Replace with the first 100 (the API maximum), then append the rest
+            sp.playlist_replace_items(playlist_id, track_uris[:100])
+            for i in range(100, len(track_uris), 100):
+                sp.playlist_add_items(playlist_id, track_uris[i:i + 100])
         else:
             for i in range(0, len(track_uris), 100):
                 sp.playlist_add_items(playlist_id, track_uris[i:i + 100])
-                if i + 100 < len(track_uris): time.sleep(0.2)
         print(f"Successfully updated playlist ID {playlist_id}.")
         return True
     except Exception as e:
         print(f"Error updating playlist {playlist_id}: {e}")
         return False
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build a playlist of new Gemini-recommended songs from your Spotify Liked Songs.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always call Gemini, even when GEMINI_CACHE=1 is set.")
+    return parser.parse_args()
+
 # --- Main Execution ---
 if __name__ == "__main__":
+    args = parse_args()
     if not all([SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT_URI, GOOGLE_AI_API_KEY]):
         print("Error: Missing environment variables (Spotify or Google AI). Please check .env file."); exit(1)
 
@@ -321,37 +769,63 @@ if __name__ == "__main__":
     user_id = user_info['id']
     print(f"Logged in as: {user_info.get('display_name', user_id)}")
 
+    rejected_songs_keys = load_rejected_songs(user_id)
+
     all_my_liked_songs_details = get_all_liked_songs_details(sp_client)
+    if all_my_liked_songs_details is None:
+        print("Could not fetch all liked songs; stopping so liked songs aren't recommended back."); exit(1)
     if not all_my_liked_songs_details:
         print("No liked songs found. Exiting."); exit()
     
-    all_my_liked_songs_set = set()
+    liked_song_keys = []
     for song_detail in all_my_liked_songs_details:
-        track = song_detail.get('track', "").strip().lower()
-        artist = song_detail.get('artist', "").strip().lower()
-        if track and artist:
-            all_my_liked_songs_set.add((track, artist))
-    print(f"Created set of {len(all_my_liked_songs_set)} unique liked songs (name/artist) for de-duplication.")
+        if song_detail['_norm_track'] and song_detail['_norm_artist']:
+            liked_song_keys.append(song_key(song_detail['_norm_track'], song_detail['_norm_artist']))
+    liked_song_fingerprints = build_fingerprint_index(liked_song_keys)
+    print(f"Created index of {len(liked_song_fingerprints)} unique liked songs (name/artist) for de-duplication.")
+
+    embedding_cache = None
+    liked_song_embeddings = None
+    suggestion_embeddings = None
+    if SEMANTIC_DUPLICATE_THRESHOLD is not None:
+        embedding_cache = EmbeddingCache()
+        try:
+            liked_song_embeddings = embedding_cache.embed(all_my_liked_songs_details)
+            suggestion_embeddings = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        except Exception as e:
+            print(f"Warning: Could not embed liked songs, semantic de-duplication disabled: {e}")
+        embedding_cache.save()
+
+    gemini_cache = None
+    if GEMINI_CACHE_ENABLED and not args.no_cache:
+        gemini_cache = GeminiCache()
+        random.seed(GEMINI_CACHE_SHUFFLE_SEED)
 
     random.shuffle(all_my_liked_songs_details)
     sample_liked_songs_for_gemini_prompt = all_my_liked_songs_details[:MAX_SONGS_TO_GEMINI_PROMPT]
 
-    all_recs_playlist_id = get_or_create_playlist_id(sp_client, user_id, ALL_RECS_PLAYLIST_NAME)
+    try:
+        all_recs_playlist_id = get_or_create_playlist_id(sp_client, user_id, ALL_RECS_PLAYLIST_NAME)
+    except Exception as e:
+        print(f"Error fetching your playlists: {e}")
+        print(f"Stopping so a duplicate '{ALL_RECS_PLAYLIST_NAME}' playlist isn't created."); exit(1)
     existing_all_recs_songs_details = []
     if all_recs_playlist_id:
         existing_all_recs_songs_details = get_playlist_tracks_simplified(sp_client, all_recs_playlist_id)
+        if existing_all_recs_songs_details is None:
+            print(f"Could not fetch all of '{ALL_RECS_PLAYLIST_NAME}'; stopping so past recommendations aren't repeated."); exit(1)
     
-    all_recs_history_track_ids_set = set()
-    for song_detail in existing_all_recs_songs_details:
-        if song_detail.get('id'):
-            all_recs_history_track_ids_set.add(song_detail['id'])
-    print(f"Found {len(all_recs_history_track_ids_set)} unique track IDs in '{ALL_RECS_PLAYLIST_NAME}' history.")
+    all_recs_history_fingerprints = build_fingerprint_index(
+        song_detail['id'] for song_detail in existing_all_recs_songs_details if song_detail.get('id')
+    )
+    print(f"Found {len(all_recs_history_fingerprints)} unique track IDs in '{ALL_RECS_PLAYLIST_NAME}' history.")
 
     collected_new_songs_for_playlist_uris = []
     collected_new_songs_for_playlist_details = [] 
+    collected_ids = set()
     
-    conversation_history = [] # Will store messages for Google AI API
     all_gemini_suggestions_this_session_raw_details = [] 
+    total_suggested_count = 0 # Gemini suggestions received, used to estimate the keep rate
 
     liked_songs_prompt_str = "\n".join([f"- \"{s['track']}\" by {s['artist']}" for s in sample_liked_songs_for_gemini_prompt])
     
@@ -374,9 +848,9 @@ Here are some songs I like:
 {liked_songs_prompt_str}
 
 Please provide {TARGET_NEW_SONGS_COUNT} new song recommendations in the specified JSON format, keeping all the above criteria in mind."""
-    # For Google AI, the first message is "user"
-    conversation_history.append({"role": "user", "content": initial_user_prompt_content})
-
+    # The chat session keeps the conversation history for us (no manual role bookkeeping).
+    # It lives client-side: every send_message still sends the whole history to Gemini.
+    gemini_chat = _GEMINI_MODEL.start_chat(history=[])
 
     for attempt in range(MAX_GEMINI_ATTEMPTS):
         if len(collected_new_songs_for_playlist_uris) >= TARGET_NEW_SONGS_COUNT:
@@ -385,38 +859,43 @@ Please provide {TARGET_NEW_SONGS_COUNT} new song recommendations in the specifie
 
         print(f"\n--- Gemini Request Attempt {attempt + 1}/{MAX_GEMINI_ATTEMPTS} ---")
         
-        # The conversation_history already has the user prompt from the previous iteration or the initial one.
-        # If it's not the first attempt, the last message in history is the model's previous response.
-        # We need to add a NEW user prompt for the follow-up.
-        if attempt > 0:
+        # Until Gemini has answered the initial prompt (with the liked songs), keep sending it.
+        # After that, each attempt sends a NEW follow-up user prompt.
+        user_prompt_content = initial_user_prompt_content
+        if gemini_chat.history:
+            # Ask for enough songs to fill the playlist at the keep rate observed so far.
+            # With no suggestions counted yet there is no keep rate, so just ask for what's missing.
+            songs_still_needed = TARGET_NEW_SONGS_COUNT - len(collected_new_songs_for_playlist_uris)
+            songs_to_request = songs_still_needed
+            if total_suggested_count > 0:
+                keep_rate = max(MIN_EXPECTED_KEEP_RATE,
+                                len(collected_new_songs_for_playlist_uris) / total_suggested_count)
+                songs_to_request = min(MAX_SONGS_PER_GEMINI_REQUEST, math.ceil(songs_still_needed / keep_rate))
+                print(f"Keep rate so far: {keep_rate:.0%}. Asking Gemini for {songs_to_request} songs.")
+
+            # Only repeat the most recent suggestions so the prompt doesn't grow with every attempt
+            recent_suggestions = all_gemini_suggestions_this_session_raw_details[-MAX_PREVIOUS_SUGGESTIONS_IN_PROMPT:]
             songs_suggested_by_gemini_this_session_str = "\n".join(
-                [f"- \"{s['track']}\" by {s['artist']}" for s in all_gemini_suggestions_this_session_raw_details]
+                [f"- \"{s['track']}\" by {s['artist']}" for s in recent_suggestions]
             )
             if not songs_suggested_by_gemini_this_session_str:
                 songs_suggested_by_gemini_this_session_str = "(None previously suggested in this session)"
+            elif len(all_gemini_suggestions_this_session_raw_details) > len(recent_suggestions):
+                songs_suggested_by_gemini_this_session_str += (
+                    f"\n(These are the latest {len(recent_suggestions)}; see prior turns for the full list of "
+                    f"{len(all_gemini_suggestions_this_session_raw_details)} already-suggested songs.)"
+                )
+
+            user_prompt_content = FOLLOW_UP_PROMPT_TEMPLATE.format(
+                songs_to_request=songs_to_request,
+                previous_suggestions=songs_suggested_by_gemini_this_session_str
+            )
 
-            follow_up_user_prompt_content = f"""Thank you. Now, please provide {TARGET_NEW_SONGS_COUNT} MORE unique song recommendations.
-It's crucial that these new recommendations are different from any songs you've already suggested to me in this conversation. For reference, here are the songs you've suggested so far (please avoid these entirely):
-{songs_suggested_by_gemini_this_session_str}
-
-Also, ensure these new recommendations are different from the initial list of liked songs I provided (at the very start of our conversation).
-Remember my core preferences for music that is challenging, thoughtful, inspiring, and NEW (ideally released {MIN_RELEASE_YEAR or 'any year'} or later, by lesser-known or emerging artists, and not overly popular - e.g. Spotify popularity < {MAX_POPULARITY_THRESHOLD or 'any score'}).
-My style preferences: {FAVORED_STYLES_HINT}
-Elements to avoid: {DISFAVORED_ELEMENTS_HINT}
-Ensure artist variety in this new batch.
-
-Your response must be ONLY a valid JSON array of objects, with "track" and "artist" keys, as before."""
-            conversation_history.append({"role": "user", "content": follow_up_user_prompt_content})
-
-        gemini_batch_recs_parsed, raw_model_response_str = get_gemini_recommendations_google_ai(
-            GOOGLE_AI_API_KEY,
-            conversation_history, # Pass the current history
-            GEMINI_MODEL
+        gemini_batch_recs_parsed, _ = get_gemini_recommendations_google_ai(
+            gemini_chat,
+            user_prompt_content,
+            cache=gemini_cache
         )
-
-        if raw_model_response_str:
-            # Add model's response to history for the next turn
-            conversation_history.append({"role": "model", "content": raw_model_response_str})
         
         if not gemini_batch_recs_parsed:
             print("Gemini returned no validly structured recommendations or there was an API error.")
@@ -425,22 +904,41 @@ Your response must be ONLY a valid JSON array of objects, with "track" and "arti
         
         for rec in gemini_batch_recs_parsed:
             all_gemini_suggestions_this_session_raw_details.append(rec)
+        total_suggested_count += len(gemini_batch_recs_parsed)
+
+        # Drop suggestions that already failed verification or filtering, before any API calls
+        batch_size_before = len(gemini_batch_recs_parsed)
+        gemini_batch_recs_parsed = [
+            rec for rec in gemini_batch_recs_parsed if normalized_song_key(rec) not in rejected_songs_keys
+        ]
+        if len(gemini_batch_recs_parsed) < batch_size_before:
+            print(f"Skipping {batch_size_before - len(gemini_batch_recs_parsed)} suggestions that were rejected before.")
+
+        if suggestion_embeddings is not None:
+            gemini_batch_recs_parsed, suggestion_embeddings = drop_semantic_duplicates(
+                gemini_batch_recs_parsed, suggestion_embeddings, liked_song_embeddings, embedding_cache
+            )
         
-        enriched_spotify_songs_this_batch = verify_and_filter_songs_on_spotify(sp_client, gemini_batch_recs_parsed)
+        enriched_spotify_songs_this_batch, not_found_this_batch = asyncio.run(
+            verify_and_filter_songs_on_spotify_async(sp_client, gemini_batch_recs_parsed)
+        )
+        rejected_songs_keys.update(normalized_song_key(rec) for rec in not_found_this_batch)
         
+        # Check the whole batch against the liked songs and history in one vectorised pass
+        batch_is_liked = contains_fingerprints(liked_song_fingerprints, fingerprints_of(
+            song_key(s['_norm_track'], s['_norm_artist']) for s in enriched_spotify_songs_this_batch
+        ))
+        batch_is_in_history = contains_fingerprints(all_recs_history_fingerprints, fingerprints_of(
+            s['id'] for s in enriched_spotify_songs_this_batch
+        ))
+
         newly_added_this_turn_count = 0
-        for song_info in enriched_spotify_songs_this_batch:
+        for song_info, is_liked, is_in_all_recs_playlist_history in zip(
+                enriched_spotify_songs_this_batch, batch_is_liked, batch_is_in_history):
             if len(collected_new_songs_for_playlist_uris) >= TARGET_NEW_SONGS_COUNT:
                 break
 
-            spotify_track_name_lower = song_info['track'].lower()
-            spotify_artist_name_lower = song_info['artist'].lower()
-            
-            is_liked = (spotify_track_name_lower, spotify_artist_name_lower) in all_my_liked_songs_set
-            is_in_all_recs_playlist_history = song_info['id'] in all_recs_history_track_ids_set
-            is_already_collected_this_session = any(
-                s['id'] == song_info['id'] for s in collected_new_songs_for_playlist_details
-            )
+            is_already_collected_this_session = song_info['id'] in collected_ids
             is_too_popular = False
             if MAX_POPULARITY_THRESHOLD is not None and song_info['popularity'] is not None:
                 if song_info['popularity'] > MAX_POPULARITY_THRESHOLD:
@@ -458,6 +956,7 @@ Your response must be ONLY a valid JSON array of objects, with "track" and "arti
                 
                 collected_new_songs_for_playlist_uris.append(song_info['uri'])
                 collected_new_songs_for_playlist_details.append(song_info)
+                collected_ids.add(song_info['id'])
                 newly_added_this_turn_count +=1
                 print(f"  ++ COLLECTED: '{song_info['track']}' by {song_info['artist']} (Pop: {song_info['popularity']}, Year: {song_info['release_year']})")
             else:
@@ -467,6 +966,8 @@ Your response must be ONLY a valid JSON array of objects, with "track" and "arti
                 if is_already_collected_this_session: reasons.append("already collected this session")
                 if is_too_popular: reasons.append(f"too popular (Pop: {song_info['popularity']} > {MAX_POPULARITY_THRESHOLD})")
                 if is_too_old: reasons.append(f"too old (Year: {song_info['release_year']} < {MIN_RELEASE_YEAR})")
+                if is_in_all_recs_playlist_history or is_too_popular or is_too_old:
+                    rejected_songs_keys.add(normalized_song_key(song_info['suggestion']))
                 print(f"  -- SKIPPED: '{song_info['track']}' by {song_info['artist']} (Pop: {song_info['popularity']}, Year: {song_info['release_year']}). Reasons: {', '.join(reasons) or 'unknown'}")
 
         print(f"Added {newly_added_this_turn_count} new songs this turn.")
@@ -477,6 +978,10 @@ Your response must be ONLY a valid JSON array of objects, with "track" and "arti
         elif attempt < MAX_GEMINI_ATTEMPTS -1 :
             time.sleep(3)
 
+    save_rejected_songs(user_id, rejected_songs_keys)
+    if embedding_cache is not None:
+        embedding_cache.save()
+
     final_uris_for_new_playlist = collected_new_songs_for_playlist_uris[:TARGET_NEW_SONGS_COUNT]
     final_details_for_all_recs_update = collected_new_songs_for_playlist_details[:TARGET_NEW_SONGS_COUNT]
 